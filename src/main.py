@@ -1,27 +1,35 @@
-import json
 import logging
 import traceback
 import sys
 import os
 import time
-from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor
+import math
+import asyncio
+from collections import deque
+from datetime import datetime
 import threading
-import requests
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import queue
+import shutil
+from urllib.parse import urlsplit, urlunsplit
+import aiohttp
+from aiohttp import web
+import orjson
+import uvloop
 
 
 def setup_logger(name):
     """
-    setup logger
+    setup logger, safe to call repeatedly:
+    the handler is attached only once
     """
     level = logging.INFO
-    formatter = logging.Formatter("%(asctime)s:%(levelname)s:%(message)s")
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(formatter)
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    logger.addHandler(handler)
+    if not logger.handlers:
+        formatter = logging.Formatter("%(asctime)s:%(levelname)s:%(message)s")
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
     return logger
 
 
@@ -42,6 +50,46 @@ def full_stack():
     return stackstr
 
 
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+# pooled connections and simultaneous probes per host
+PER_HOST_LIMIT = 4
+
+
+def canonical_url(url):
+    """
+    normalize url so trivially different
+    spellings of one endpoint compare equal:
+    lowercase scheme and host, no default port,
+    no fragment, '/' for an empty path;
+    a url that can't be parsed is kept as is
+    and will just be recorded as down
+    """
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    host = parts.hostname or ''
+    if ':' in host:
+        host = '[%s]' % host
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        host += ':%d' % port
+    if '@' in parts.netloc:
+        host = parts.netloc.rsplit('@', 1)[0] + '@' + host
+    return urlunsplit((scheme, host, parts.path or '/', parts.query, ''))
+
+
+def url_host(url):
+    """netloc of url, the url itself
+    if it can't be parsed"""
+    try:
+        return urlsplit(url).netloc
+    except ValueError:
+        return url
+
+
 class UptimeMonitor:
     """
     a class to perform monitoring,
@@ -53,102 +101,283 @@ class UptimeMonitor:
         retention_time - how long store data, minutes
         check_period - how often check each endpoint, seconds
         """
-        self.urls = urls
-        self.pool = ThreadPoolExecutor(50)
+        # probing the same endpoint twice is pointless
+        self.urls = list(dict.fromkeys(canonical_url(url) for url in urls if url.strip()))
+        # caps simultaneous probes, large url lists would otherwise
+        # exhaust sockets and get ConnectionRefusedError
+        self.semaphore = asyncio.Semaphore(50)
+        # probes wait for a per-host slot before the timed request
+        # starts, so queueing behind other probes to the same host
+        # doesn't count against the timeout
+        self.host_semaphores = {url_host(url): asyncio.Semaphore(PER_HOST_LIMIT)
+                                for url in self.urls}
         self.logger = setup_logger('logger')
         self.dump_file = dump_file
+        # samples recorded since the last dump, prev_wal_file
+        # holds the ones of a dump still being written
+        self.wal_file = dump_file + '.wal'
+        self.prev_wal_file = self.wal_file + '.prev'
+        # dumps are written by dump_worker, one at a time
+        self._dump_queue = queue.Queue(maxsize=1)
+        self._dump_idle = threading.Event()
+        self._dump_idle.set()
 
-        self.retention_time = timedelta(minutes=retention_time)
+        self.retention_time = float(retention_time * 60)
         self.check_period = check_period
+        # one sample per check_period, so retention bounds
+        # how many samples a url can ever hold
+        self.maxlen = math.ceil(self.retention_time / check_period)
+        self.mask = (1 << self.maxlen) - 1
 
+        # url -> timestamps of its samples, oldest first
         self.data = {}
+        # url -> statuses of the same samples packed into an int,
+        # the newest one is the lowest bit
+        self.status = {}
+        # serialized http responses, reset on every
+        # data change and rebuilt on the next request
+        self._agg_cache = None
+        self._full_cache = None
         # trying to restore data after crash:
         try:
-            with open(self.dump_file) as f:
-                js = json.load(f)
-                self.data = self.json_to_data(js)
-            # delete urls that could be in dump but not desired anymore
-            durls = list(self.data.keys())
-            for url in durls:
-                if url not in self.urls:
-                    del self.data[url]
+            with open(self.dump_file, 'rb') as f:
+                js = orjson.loads(f.read())
+            # built aside and kept only if the whole dump parses,
+            # urls that could be in dump but not desired anymore
+            # are skipped
+            data, status = {}, {}
+            for url, (times, values) in self.json_to_data(js).items():
+                if url in self.urls:
+                    data[url] = deque(times, maxlen=self.maxlen)
+                    status[url] = self.pack_status(values) & self.mask
+            self.data, self.status = data, status
         except Exception as e:
             self.logger.error('dump loading failed')
             self.logger.error(e)
             self.logger.error(full_stack())
-        for url in urls:
+        for url in self.urls:
             if url not in self.data:
-                self.data[url] = {}
+                self.data[url] = deque(maxlen=self.maxlen)
+                self.status[url] = 0
+        try:
+            self.replay_wal(self.prev_wal_file)
+            self.replay_wal(self.wal_file)
+        except Exception as e:
+            self.logger.error('wal replay failed')
+            self.logger.error(e)
+            self.logger.error(full_stack())
+        self.open_wal()
 
-    def check_url(self, url):
+    async def check_url(self, session, url):
         """
         perform a http query
         and save whether statuscode 200
-        or not
+        or not; HEAD is enough for that,
+        GET is used only if HEAD is not allowed
+        and its body is never read
         """
         res = 0
         try:
-            r = requests.get(url, timeout=3)
-            if r.status_code == 200:
+            async with self.host_semaphores[url_host(url)], self.semaphore:
+                async with session.head(url, allow_redirects=True) as r:
+                    code = r.status
+                if code in (405, 501):
+                    async with session.get(url) as r:
+                        code = r.status
+            if code == 200:
                 res = 1
         except Exception:
             pass
-        # self.data[url][str(datetime.now()).split(".")[0]] = res
-        self.data[url][datetime.now()] = res
+        ts = time.time()
+        self.add_sample(url, ts, res)
+        self.invalidate_cache()
+        self.log_sample(url, ts, res)
+
+    def open_wal(self):
+        """
+        open the wal for appending, if that fails
+        samples are kept in memory only until
+        the next rotation tries again
+        """
+        try:
+            self.wal = open(self.wal_file, 'ab')
+        except Exception as e:
+            self.wal = None
+            self.logger.error('wal open failed')
+            self.logger.error(e)
+            self.logger.error(full_stack())
+
+    def log_sample(self, url, ts, res):
+        """
+        append a sample to the wal, a failed write
+        costs durability of this sample only,
+        monitoring has to go on
+        """
+        if self.wal is None:
+            return
+        try:
+            self.wal.write(orjson.dumps((url, ts, res)) + b'\n')
+            self.wal.flush()
+        except Exception as e:
+            self.logger.error('wal write failed')
+            self.logger.error(e)
+            self.logger.error(full_stack())
+
+    def replay_wal(self, path):
+        """
+        append samples logged after the last dump,
+        skipping ones the dump already has and
+        a torn last line left by a crash
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    url, ts, res = orjson.loads(line)
+                except ValueError:
+                    continue
+                if url not in self.data:
+                    continue
+                times = self.data[url]
+                if times and ts <= times[-1]:
+                    continue
+                self.add_sample(url, ts, res)
+
+    def add_sample(self, url, ts, res):
+        """
+        append a sample, once maxlen samples are
+        stored the deque drops the oldest timestamp
+        and the mask drops its status bit
+        """
+        self.data[url].append(ts)
+        self.status[url] = (self.status[url] << 1 | res) & self.mask
 
     def delete_expired(self):
         """
         delete all the data points
-        older than specified retention_time
+        older than specified retention_time,
+        samples are appended in time order so
+        expired ones are always at the head
         """
 
-        now = datetime.now()
-        for url, data in self.data.items():
-            to_delete = []
-            for t in data:
-                if t + self.retention_time < now:
-                    to_delete.append(t)
-            for t in to_delete:
-                del data[t]
+        cutoff = time.time() - self.retention_time
+        for url, times in self.data.items():
+            if not times or times[0] >= cutoff:
+                continue
+            while times and times[0] < cutoff:
+                times.popleft()
+            # oldest samples are the highest bits
+            self.status[url] &= (1 << len(times)) - 1
+            self.invalidate_cache()
 
     @staticmethod
     def json_to_data(j):
-        """convert date from loaded
-        json from str to datetime"""
+        """split loaded [timestamp, status] pairs
+        into (timestamps, statuses) for every url"""
         res = {}
         for url, data in j.items():
-            res[url] = {}
-            for st, value in data.items():
-                st = datetime.strptime(st, '%Y-%m-%d %H:%M:%S')
-                res[url][st] = value
+            # zip(*) transposes the pairs in C
+            res[url] = tuple(zip(*data)) if data else ((), ())
         return res
 
     def data_to_json(self):
-        """it is impossible to convert a dict
-        with datetime as it is, so we have to convert
-        it to datetime first"""
+        """pair up timestamp and status columns,
+        json keeps unix timestamps as plain floats"""
         res = {}
-        for url, data in self.data.items():
-            res[url] = {}
-            for _datetime, value in data.items():
-                res[url][str(_datetime).split(".")[0]] = value
+        for url, times in self.data.items():
+            res[url] = list(zip(times, self.unpack_status(self.status[url], len(times))))
         return res
 
+    @staticmethod
+    def pack_status(status):
+        """pack zeros and ones into an int,
+        the last one becomes the lowest bit; goes
+        through a binary string, shifting the int per
+        sample would copy it every time"""
+        return int(''.join(map(str, status)) or '0', 2)
+
+    @staticmethod
+    def unpack_status(bits, n):
+        """list n lowest bits of an int,
+        the highest one first"""
+        if not n:
+            return []
+        return list(map(int, format(bits, '0%db' % n)))
+
+    def rotate_wal(self):
+        """
+        move logged samples aside for the dump
+        being written, leftovers of a failed dump
+        are kept and appended to
+        """
+        if self.wal is not None:
+            self.wal.close()
+        try:
+            if not os.path.exists(self.wal_file):
+                # the wal could not be opened, nothing to move
+                return
+            if os.path.exists(self.prev_wal_file):
+                with open(self.wal_file, 'rb') as src, open(self.prev_wal_file, 'ab') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(self.wal_file)
+            else:
+                os.replace(self.wal_file, self.prev_wal_file)
+        finally:
+            # on failure the wal is still in place
+            # and logging goes on appending to it
+            self.open_wal()
+
     def dump_data(self):
         """ save data as json in case of
-        service crash
+        service crash, only the payload is built here,
+        the file is written by dump_worker; a dump
+        requested while the previous one is still
+        being written is dropped
         """
-        with open(self.dump_file, 'w') as f:
-            json.dump(self.data_to_json(), f)
+        if not self._dump_idle.is_set():
+            self.logger.warning('previous dump still in progress, skipping')
+            return
+        self._dump_idle.clear()
+        try:
+            payload = orjson.dumps(self.data_to_json())
+            self.rotate_wal()
+            self._dump_queue.put_nowait(payload)
+        except Exception:
+            # nothing was queued, so no worker will set it
+            self._dump_idle.set()
+            raise
+
+    def dump_worker(self):
+        """
+        write queued dumps to disk off the
+        monitor loop, once a dump is in place
+        the rotated wal is no longer needed
+        """
+        while True:
+            payload = self._dump_queue.get()
+            try:
+                tmp_file = self.dump_file + '.tmp'
+                with open(tmp_file, 'wb') as f:
+                    f.write(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, self.dump_file)
+                if os.path.exists(self.prev_wal_file):
+                    os.remove(self.prev_wal_file)
+            except Exception as e:
+                self.logger.error('dump failed')
+                self.logger.error(e)
+                self.logger.error(full_stack())
+            finally:
+                self._dump_idle.set()
 
     @staticmethod
-    def calculate_uptime(l):
+    def calculate_uptime(ones, total):
         """
-        takes a list with zeros and ones,
-        returns just a percentage of ones
+        takes a count of ones out of total
+        samples, returns just a percentage of ones
         """
-        total = len(l)
-        ones = l.count(1)
         return round(ones / total * 100, 2)
 
     def uptime(self):
@@ -157,62 +386,119 @@ class UptimeMonitor:
         to expose it as json via http
         """
         res = {}
-        for url, data in self.data.items():
-            res[url] = {'points_count': len(data),
-                        'oldest': str(min(data.keys())),
-                        'newest': str(max(data.keys())),
-                        'uptime': self.calculate_uptime(list(data.values()))}
+        for url, times in self.data.items():
+            # no samples yet or all of them expired
+            if not times:
+                res[url] = {'points_count': 0, 'oldest': None,
+                            'newest': None, 'uptime': None}
+                continue
+            res[url] = {'points_count': len(times),
+                        'oldest': str(datetime.fromtimestamp(times[0])),
+                        'newest': str(datetime.fromtimestamp(times[-1])),
+                        'uptime': self.calculate_uptime(self.status[url].bit_count(), len(times))}
         return res
 
-    def run(self):
+    def invalidate_cache(self):
+        """drop cached http responses"""
+        self._agg_cache = None
+        self._full_cache = None
+
+    def aggregated_bytes(self):
+        """uptime() as encoded json,
+        cached until data changes"""
+        if self._agg_cache is None:
+            self._agg_cache = orjson.dumps(self.uptime())
+        return self._agg_cache
+
+    def full_bytes(self):
+        """data_to_json() as encoded json,
+        cached until data changes"""
+        if self._full_cache is None:
+            self._full_cache = orjson.dumps(self.data_to_json())
+        return self._full_cache
+
+    def make_session(self):
         """
-        do all the stuff in the loop
+        session shared by all probes: probes to the
+        same host share a few pooled connections,
+        idle ones and resolved addresses must outlive
+        a tick to be reused by the next one
         """
-        while True:
-            self.logger.info('updating metrics')
-            try:
-                self.dump_data()
-                self.delete_expired()
-                for url in self.urls:
-                    self.pool.submit(self.check_url, url)
-                    # self.check_url(url)
-            except Exception as e:
-                self.logger.error(e)
-                self.logger.error(full_stack())
-            time.sleep(self.check_period)
-
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=PER_HOST_LIMIT,
+                                         use_dns_cache=True,
+                                         ttl_dns_cache=max(300, self.check_period * 2),
+                                         keepalive_timeout=max(60, self.check_period * 2))
+        timeout = aiohttp.ClientTimeout(total=3)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
 
-class Server(BaseHTTPRequestHandler):
-    """
-    A HTTP server to expose data
-    """
+    async def run(self):
+        """
+        do all the stuff in the loop,
+        all probes share one session so
+        connections are kept alive between checks
+        """
+        threading.Thread(target=self.dump_worker, daemon=True).start()
+        async with self.make_session() as session:
+            tick = 0
+            next_tick = time.monotonic()
+            while True:
+                # ticks are scheduled on the monotonic clock, so
+                # wall clock jumps and the work below don't shift them
+                next_tick = max(next_tick + self.check_period, time.monotonic())
+                self.logger.info('updating metrics')
+                # full dump once per retention window,
+                # samples in between only go to the wal;
+                # a failed dump must not hold back expiry
+                if tick % self.maxlen == 0:
+                    try:
+                        self.dump_data()
+                    except Exception as e:
+                        self.logger.error(e)
+                        self.logger.error(full_stack())
+                tick += 1
+                try:
+                    self.delete_expired()
+                except Exception as e:
+                    self.logger.error(e)
+                    self.logger.error(full_stack())
+                # probes run alongside the sleep, so a tick
+                # still takes check_period seconds
+                await asyncio.gather(asyncio.sleep(next_tick - time.monotonic()),
+                                     *(self.check_url(session, url) for url in self.urls))
 
-    def _set_headers(self, code):
-        self.send_response(code)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
 
-    def do_HEAD(self):
-        """wtf"""
-        self._set_headers(200)
+# path -> monitor method returning encoded body
+ROUTES = {'/full': UptimeMonitor.full_bytes,
+          '/aggregated': UptimeMonitor.aggregated_bytes}
 
-    def do_GET(self):
-        """execute on get"""
-        if self.path == '/full':
-            self._set_headers(200)
-            self.wfile.write(json.dumps(monitor.data_to_json()).encode('utf-8'))
-        if self.path == '/aggregated':
-            self._set_headers(200)
-            self.wfile.write(json.dumps(monitor.uptime()).encode('utf-8'))
 
+def route_handler(monitor, route):
+    """make an aiohttp handler
+    serving a cached body"""
+    async def handler(request):
+        return web.Response(body=route(monitor), content_type='application/json')
+    return handler
 
-def run_http_server(server_class=HTTPServer, handler_class=Server, port=80):
-    """run http server"""
-    server_address = ('', port)
-    httpd = server_class(server_address, handler_class)
 
+async def run_http_server(monitor, port=80):
+    """
+    run http server on the same event
+    loop as the monitor, GET routes
+    answer HEAD as well
+    """
+    app = web.Application()
+    for path, route in ROUTES.items():
+        app.router.add_get(path, route_handler(monitor, route))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
     print('Starting http on port %d...' % port)
-    httpd.serve_forever()
+
+
+async def main(monitor):
+    """serve http and monitor"""
+    await run_http_server(monitor)
+    await monitor.run()
 
 
 if __name__ == "__main__":
@@ -227,5 +513,4 @@ if __name__ == "__main__":
     monitor = UptimeMonitor(urls, dump_file,
                             retention_time=retention_time, check_period=check_period)
 
-    threading.Thread(target=run_http_server, args=()).start()
-    monitor.run()
+    uvloop.run(main(monitor))
@@ -0,0 +1,162 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import tempfile
+import unittest
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from main import UptimeMonitor, canonical_url  # noqa: E402
+
+
+class CheckUrlTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        async def slow(request):
+            await asyncio.sleep(1)
+            return web.Response()
+
+        app = web.Application()
+        app.router.add_get('/{n}', slow)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+        self.tmp = tempfile.TemporaryDirectory()
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    async def test_many_urls_on_one_host(self):
+        """probes queued behind the per-host
+        limit must not time out"""
+        urls = ['http://127.0.0.1:%d/%d' % (self.port, n) for n in range(20)]
+        monitor = UptimeMonitor(urls, os.path.join(self.tmp.name, 'dump.json'))
+        async with monitor.make_session() as session:
+            await asyncio.gather(*(monitor.check_url(session, url) for url in monitor.urls))
+        monitor.wal.close()
+        self.assertEqual({url: monitor.status[url] for url in monitor.urls},
+                         dict.fromkeys(monitor.urls, 1))
+
+
+class StatusBitmapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.monitor = UptimeMonitor(['http://a/'], os.path.join(self.tmp.name, 'dump.json'),
+                                     retention_time=1, check_period=1)
+
+    def tearDown(self):
+        self.monitor.wal.close()
+        self.tmp.cleanup()
+
+    def test_pack_unpack_round_trip(self):
+        status = [1, 0, 0, 1, 1, 0, 1] * 1000
+        bits = UptimeMonitor.pack_status(status)
+        self.assertEqual(UptimeMonitor.unpack_status(bits, len(status)), status)
+        self.assertEqual(UptimeMonitor.unpack_status(0, 0), [])
+        self.assertEqual(UptimeMonitor.pack_status([]), 0)
+
+    def test_uptime_without_samples(self):
+        self.assertEqual(self.monitor.uptime()['http://a/'],
+                         {'points_count': 0, 'oldest': None, 'newest': None, 'uptime': None})
+
+    def test_round_trip_after_expiry(self):
+        """maxlen drops and expiry masking keep
+        statuses aligned with timestamps"""
+        now = time.time()
+        samples = [(now - 100 + i, i % 3 and 1) for i in range(100)]
+        for ts, res in samples:
+            self.monitor.add_sample('http://a/', ts, res)
+        self.monitor.retention_time = 30.5
+        self.monitor.delete_expired()
+        expected = [(ts, res) for ts, res in samples if ts >= now - 30.5]
+        self.assertEqual(self.monitor.data_to_json()['http://a/'], expected)
+        self.assertEqual(self.monitor.status['http://a/'].bit_count(),
+                         sum(res for _, res in expected))
+
+
+class WalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dump_file = os.path.join(self.tmp.name, 'dump.json')
+        self.ts = time.time() - 100
+        self.logged = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def start(self):
+        monitor = UptimeMonitor(['http://a/'], self.dump_file)
+        threading.Thread(target=monitor.dump_worker, daemon=True).start()
+        return monitor
+
+    def log(self, monitor, count):
+        for _ in range(count):
+            self.ts += 1
+            res = len(self.logged) % 2
+            monitor.add_sample('http://a/', self.ts, res)
+            monitor.log_sample('http://a/', self.ts, res)
+            self.logged.append((self.ts, res))
+
+    def dump(self, monitor):
+        monitor.dump_data()
+        monitor._dump_idle.wait(5)
+
+    def restart(self, monitor):
+        monitor.wal.close()
+        monitor = self.start()
+        self.assertEqual(monitor.data_to_json()['http://a/'], self.logged)
+        return monitor
+
+    def test_failed_dumps_and_restart(self):
+        """no sample is lost or duplicated when dumps
+        fail, succeed later and the service restarts"""
+        monitor = self.start()
+        self.log(monitor, 3)
+        # the worker can't write the dump while its temp path is a directory
+        os.mkdir(self.dump_file + '.tmp')
+        self.dump(monitor)
+        self.log(monitor, 2)
+        self.dump(monitor)
+        self.log(monitor, 1)
+        self.assertFalse(os.path.exists(self.dump_file))
+        self.assertTrue(os.path.exists(monitor.prev_wal_file))
+        monitor = self.restart(monitor)
+
+        os.rmdir(self.dump_file + '.tmp')
+        self.dump(monitor)
+        self.assertTrue(os.path.exists(self.dump_file))
+        self.assertFalse(os.path.exists(monitor.prev_wal_file))
+        self.log(monitor, 2)
+        self.restart(monitor).wal.close()
+
+    def test_unwritable_wal_does_not_stop_monitoring(self):
+        self.dump_file = os.path.join(self.tmp.name, 'missing', 'dump.json')
+        monitor = self.start()
+        self.assertIsNone(monitor.wal)
+        self.log(monitor, 2)
+        self.dump(monitor)
+        self.assertEqual(monitor.data_to_json()['http://a/'], self.logged)
+
+
+class CanonicalUrlTest(unittest.TestCase):
+
+    def test_spellings_of_one_endpoint(self):
+        self.assertEqual(canonical_url(' HTTPS://Example.com:443#top'), 'https://example.com/')
+
+    def test_malformed_port_is_kept(self):
+        """a typo must not stop the service"""
+        for url in ('http://host:abc/', 'http://host:99999/', 'http://[::1/'):
+            self.assertEqual(canonical_url(url), url)
+
+
+if __name__ == '__main__':
+    unittest.main()